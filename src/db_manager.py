@@ -2,6 +2,11 @@ import sqlite3
 import os
 from datetime import datetime
 
+# Defaults for reporting files that share chunks: pairs sharing less than 1 MiB are left out, and chunks found
+# in more than 100 files (such as zero-filled blocks) are ignored so they don't pair up every file with every other.
+SHARED_MIN_BYTES = 1048576
+SHARED_MAX_CHUNK_FILES = 100
+
 class DBManager:
     def __init__(self, db_path="file_hashes.db"):
         """Initialize the database connection."""
@@ -15,6 +20,10 @@ class DBManager:
         self.cursor = self.conn.cursor()
         if not db_exists:
             self.initialize_db()
+        else:
+            # Databases created before chunking was added have no chunks table yet
+            self.initialize_chunks()
+            self.fix_swapped_paths()
         
     def initialize_db(self):
         """Create the necessary tables if they don't exist."""
@@ -45,8 +54,46 @@ class DBManager:
             CREATE INDEX IF NOT EXISTS idx_hash_value ON hashes (hash_value)
         ''')
         
+        self.initialize_chunks()
+
+    def initialize_chunks(self):
+        """Create the content-defined chunks table if it doesn't exist."""
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_hash BLOB NOT NULL,
+                file_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (file_id, offset),
+                FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
+            )
+        ''')
+
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chunk_hash ON chunks (chunk_hash)
+        ''')
+
         self.conn.commit()
 
+    def fix_swapped_paths(self):
+        """Swap back file_name and path on rows where earlier versions stored them the wrong way round."""
+        try:
+            swapped = "instr(path, ?) = 0 AND instr(file_name, ?) > 0"
+            # A row for the same file may already have been stored correctly, in which case the swapped one is dropped
+            self.cursor.execute(f"SELECT id FROM files WHERE {swapped} AND file_name IN (SELECT path FROM files)", (os.sep, os.sep))
+            stale_ids = [(row[0],) for row in self.cursor.fetchall()]
+            self.cursor.executemany("DELETE FROM hashes WHERE file_id = ?", stale_ids)
+            self.cursor.executemany("DELETE FROM chunks WHERE file_id = ?", stale_ids)
+            self.cursor.executemany("DELETE FROM files WHERE id = ?", stale_ids)
+            self.cursor.execute(f"UPDATE files SET file_name = path, path = file_name WHERE {swapped}", (os.sep, os.sep))
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            self.conn.rollback()
+            return False
+
     def get_table_info(self):
         """Retrieve information about the database tables."""
         try:
@@ -67,8 +114,12 @@ class DBManager:
             print(f"Database error: {e}")
             return {}
     
-    def insert_file(self, file_path, file_name, file_size, last_modified, scan_date, file_hash):
-        """Insert or update a file's information in the database."""
+    def insert_file(self, file_path, file_name, file_size, last_modified, scan_date, file_hash, file_chunks=None):
+        """Insert or update a file's information in the database.
+
+        file_chunks optionally yields (offset, size, chunk_hash) tuples. When file_hash is None it is
+        taken from file_chunks.hexdigest() once all chunks are written, as for a ChunkedFileHash.
+        """
         # Store file info with its hash
         try:
             # Check if the file already exists in the database     
@@ -85,6 +136,10 @@ class DBManager:
                 self.cursor.execute("INSERT INTO files (file_name, path, size, last_modified, last_scan, active) VALUES (?, ?, ?, ?, ?, TRUE)", data)
                 file_id = self.cursor.lastrowid
                 
+            if file_chunks is not None:
+                self._replace_chunks(file_id, file_chunks)
+                if file_hash is None:
+                    file_hash = file_chunks.hexdigest()
             hashes_values = [file_hash, file_id]
             self.cursor.execute("INSERT OR REPLACE INTO hashes (hash_value, file_id) VALUES (?,?)", hashes_values)
             self.conn.commit()
@@ -94,6 +149,86 @@ class DBManager:
             self.conn.rollback()
             return False
         
+    def _replace_chunks(self, file_id, file_chunks):
+        """Replace the stored chunks of a file. The caller commits."""
+        self.cursor.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+        # Chunks are streamed into the table instead of being collected in memory first
+        self.cursor.executemany(
+            "INSERT INTO chunks (chunk_hash, file_id, offset, size) VALUES (?, ?, ?, ?)",
+            ((chunk_hash, file_id, offset, size) for offset, size, chunk_hash in file_chunks)
+        )
+
+    def has_chunks(self, file_path):
+        """Check whether any chunks are stored for a file."""
+        try:
+            self.cursor.execute("SELECT 1 FROM chunks c JOIN files f ON c.file_id = f.id WHERE f.path = ? LIMIT 1", (file_path,))
+            return self.cursor.fetchone() is not None
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            self.conn.rollback()
+            return False
+
+    def set_file_chunks(self, file_path, file_chunks):
+        """Store the (offset, size, chunk_hash) chunks of a file already in the database."""
+        try:
+            self.cursor.execute("SELECT id FROM files WHERE path = ?", (file_path,))
+            file_id = self.cursor.fetchone()
+
+            if file_id:
+                self._replace_chunks(file_id[0], file_chunks)
+                self.conn.commit()
+                return True
+            return False
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            self.conn.rollback()
+            return False
+
+    def get_shared_chunks(self, min_shared_bytes=SHARED_MIN_BYTES, max_chunk_files=SHARED_MAX_CHUNK_FILES):
+        """Retrieve pairs of active, non-identical files that share at least min_shared_bytes.
+
+        shared_bytes counts every matching chunk occurrence, so it is how many bytes of the two files
+        are the same. shared_unique_bytes counts each distinct chunk once, which is what block-level
+        deduplication of the pair would store only once. Chunks found in more than max_chunk_files
+        files are left out of both.
+        """
+        try:
+            self.cursor.execute('''
+                WITH file_chunks AS (
+                    SELECT c.file_id, c.chunk_hash, c.size, COUNT(*) AS occurrences
+                    FROM chunks c JOIN files f ON c.file_id = f.id
+                    WHERE f.active = 1
+                    GROUP BY c.file_id, c.chunk_hash
+                ),
+                common_chunks AS (
+                    SELECT chunk_hash FROM file_chunks GROUP BY chunk_hash HAVING COUNT(*) > ?
+                ),
+                pairs AS (
+                    SELECT a.file_id AS file_a, b.file_id AS file_b,
+                        SUM(MIN(a.occurrences, b.occurrences) * a.size) AS shared_bytes,
+                        SUM(a.size) AS shared_unique_bytes
+                    FROM file_chunks a
+                    JOIN file_chunks b ON a.chunk_hash = b.chunk_hash AND a.file_id < b.file_id
+                    WHERE a.chunk_hash NOT IN (SELECT chunk_hash FROM common_chunks)
+                    GROUP BY a.file_id, b.file_id
+                    HAVING shared_bytes >= ?
+                )
+                SELECT fa.path AS path_a, fa.size AS size_a, fb.path AS path_b, fb.size AS size_b, p.shared_bytes, p.shared_unique_bytes
+                FROM pairs p
+                JOIN files fa ON fa.id = p.file_a
+                JOIN files fb ON fb.id = p.file_b
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM hashes ha JOIN hashes hb ON ha.hash_value = hb.hash_value
+                    WHERE ha.file_id = p.file_a AND hb.file_id = p.file_b
+                )
+                ORDER BY p.shared_bytes DESC, fa.path, fb.path
+            ''', (max_chunk_files, min_shared_bytes))
+            return [dict(row) for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            self.conn.rollback()
+            return []
+
     def get_duplicates(self):
         """Retrieve all duplicate files grouped by hash."""
         try:
@@ -269,6 +404,7 @@ class DBManager:
             if file_id:
                 file_id = file_id[0]
                 self.cursor.execute("DELETE FROM hashes WHERE file_id=?", (file_id,))
+                self.cursor.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
                 self.cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
                 self.conn.commit()
                 return True
@@ -290,9 +426,10 @@ class DBManager:
             for file_id, file_path in files:
                 if not os.path.exists(file_path):
                     self.cursor.execute("DELETE FROM hashes WHERE file_id = ?", (file_id,))
+                    self.cursor.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
                     self.cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
                     removed_count += 1
-                self.cursor.commit()
+            self.conn.commit()
             return  removed_count
         except sqlite3.Error as e:
             print(f"Database error: {e}")
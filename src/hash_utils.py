@@ -1,5 +1,19 @@
 import hashlib
 
+try:
+    from pyfastcdc import FastCDC
+except ImportError:
+    # Chunking (-c) is optional and needs the compiled pyfastcdc package
+    FastCDC = None
+
+# FastCDC parameters: chunks are cut between 2 KiB and 64 KiB, around 8 KiB apart on average.
+CDC_MIN_SIZE = 2048
+CDC_AVG_SIZE = 8192
+CDC_MAX_SIZE = 65536
+# Chunk digests are stored for every chunk of every file, so they are kept short.
+CHUNK_DIGEST_SIZE = 16
+
+
 def get_file_hash(file_path, hash_algorithm='blake2b', chunk_size=16777216):
     hasher = hashlib.new(hash_algorithm)
 
@@ -7,4 +21,55 @@ def get_file_hash(file_path, hash_algorithm='blake2b', chunk_size=16777216):
         while chunk := file.read(chunk_size):
             hasher.update(chunk)
 
-    return hasher.hexdigest()
\ No newline at end of file
+    return hasher.hexdigest()
+
+
+def chunking_available():
+    """Check whether content-defined chunking can be used."""
+    return FastCDC is not None
+
+
+class _HashingReader:
+    """File wrapper that feeds every byte read into a hasher."""
+
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+
+    def readinto(self, buffer):
+        size = self.file.readinto(buffer)
+        if size:
+            self.hasher.update(buffer[:size])
+        return size
+
+
+class ChunkedFileHash:
+    """Full-file hash and content-defined chunks of a file, computed in a single read pass.
+
+    Iterating yields (offset, size, chunk_digest) tuples one at a time, chunk_digest being
+    a short blake2b digest in bytes. hexdigest() is available once iteration has finished.
+    """
+
+    def __init__(self, file_path, hash_algorithm='blake2b'):
+        if FastCDC is None:
+            raise RuntimeError("Chunking requires the pyfastcdc package (pip install pyfastcdc).")
+        self.file_path = file_path
+        self.hash_algorithm = hash_algorithm
+        self.hasher = hashlib.new(hash_algorithm)
+        self.done = False
+
+    def __iter__(self):
+        # Every pass starts a fresh hash, so iterating again doesn't mix two reads into one digest
+        self.hasher = hashlib.new(self.hash_algorithm)
+        self.done = False
+        chunker = FastCDC(CDC_AVG_SIZE, min_size=CDC_MIN_SIZE, max_size=CDC_MAX_SIZE)
+        with open(self.file_path, 'rb') as file:
+            for chunk in chunker.cut_stream(_HashingReader(file, self.hasher)):
+                # chunk.data is only valid until the next chunk is cut
+                yield chunk.offset, chunk.length, hashlib.blake2b(chunk.data, digest_size=CHUNK_DIGEST_SIZE).digest()
+        self.done = True
+
+    def hexdigest(self):
+        if not self.done:
+            raise RuntimeError(f"File hash is not ready until all chunks are read: {self.file_path}")
+        return self.hasher.hexdigest()
@@ -1,9 +1,9 @@
-from hash_utils import get_file_hash
+from hash_utils import get_file_hash, chunking_available, ChunkedFileHash
 from file_scanner import scan_for_files
-from db_manager import DBManager
+from db_manager import DBManager, SHARED_MIN_BYTES, SHARED_MAX_CHUNK_FILES
 from datetime import datetime
 from tqdm import tqdm
-import os, argparse, shutil
+import os, sys, argparse, shutil
 
 def remove_file(file_path, db):
     """Remove a file from the filesystem."""
@@ -79,6 +79,9 @@ def main():
     parser.add_argument("-r", "--restore", help="Print all removed files and give option to restore them", action="store_true")
     parser.add_argument("-p", "--progress", help="Show progress bar", action="store_true")
     parser.add_argument("-s", "--silent", help="Run in silent mode", action="store_true")
+    parser.add_argument("-c", "--chunks", help="Split files into content-defined chunks (needs pyfastcdc) and report bytes shared between similar files", action="store_true")
+    parser.add_argument("--min-shared", help=f"Only report files sharing at least this many bytes in chunking mode (default: {SHARED_MIN_BYTES})", type=int, default=SHARED_MIN_BYTES)
+    parser.add_argument("--max-chunk-files", help=f"Ignore chunks found in more than this many files in chunking mode (default: {SHARED_MAX_CHUNK_FILES})", type=int, default=SHARED_MAX_CHUNK_FILES)
 
     args = parser.parse_args()
 
@@ -115,6 +118,11 @@ def main():
         print_message("Dry run mode enabled. No files will be deleted.", silent_mode)
     if args.assumeyes:
         print_message("Assuming yes to all prompts.", silent_mode)
+    if args.chunks:
+        if not chunking_available():
+            # Reported even in silent mode, so a scheduled run doesn't skip the scan unnoticed
+            sys.exit("Chunking mode requires the pyfastcdc package. Install it with: pip install pyfastcdc")
+        print_message("Chunking mode enabled. Shared bytes between files will be reported.", silent_mode)
     if args.restore:
         print_message("Restore mode enabled. Removed files will be listed for restoration.", silent_mode)
         print_removed_files(args.directory, db)
@@ -128,7 +136,7 @@ def main():
         print_message("No files found in the specified directory.", silent_mode)
         return
     for file in tqdm(files):
-        if db.lookup_file(file["file_name"], file["path"]):
+        if db.lookup_file(file_path=file["path"]):
             # File already exists in the database
             if args.verbose:
                 print_message(f"File already exists in the database: {file['file_name']}", silent_mode)
@@ -140,10 +148,20 @@ def main():
             else:
                 if args.verbose:
                     print_message(f"File already exists in the database: {file['file_name']}", silent_mode)
+            # Files scanned before chunking was enabled are read once more to store their chunks
+            if args.chunks and not db.has_chunks(file["path"]):
+                db.set_file_chunks(file["path"], ChunkedFileHash(file["path"]))
             continue
         else:
-            file_hash = get_file_hash(file["path"])
-            db.insert_file(file["file_name"], file["path"], file["size"], file["last_modified"], datetime.today().strftime('%Y-%m-%d %H:%M:%S'), file_hash)
+            if args.chunks:
+                # The full-file hash is taken from the same read pass once the chunks are stored
+                file_hash, file_chunks = None, ChunkedFileHash(file["path"])
+            else:
+                file_hash, file_chunks = get_file_hash(file["path"]), None
+            db.insert_file(file["path"], file["file_name"], file["size"], file["last_modified"], datetime.today().strftime('%Y-%m-%d %H:%M:%S'), file_hash, file_chunks)
+    if args.chunks:
+        for pair in db.get_shared_chunks(args.min_shared, args.max_chunk_files):
+            print_message(f"Shared chunks: {pair['path_a']} and {pair['path_b']} share {pair['shared_bytes']} bytes, {pair['shared_unique_bytes']} bytes of unique chunks ({pair['size_a']} and {pair['size_b']} bytes total)", silent_mode)
     dups =  db.get_duplicates()
     for entry in tqdm(dups):
         for duplicate in dups[entry][1:]:
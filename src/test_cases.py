@@ -1,8 +1,11 @@
 import unittest
 import os
 import time
+import random
+import sqlite3
+from collections import Counter
 from db_manager import DBManager
-from hash_utils import get_file_hash
+from hash_utils import get_file_hash, chunking_available, ChunkedFileHash, CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE
 
 class DBManagerTest(unittest.TestCase):
     def __init__(self, methodName = "runTest"):
@@ -164,6 +167,217 @@ class DBManagerTest(unittest.TestCase):
         if os.path.exists("./test_file3.txt"):
             os.remove("./test_file3.txt")    
 
+    @unittest.skipUnless(chunking_available(), "pyfastcdc is not installed")
+    def test_chunks_shared_between_similar_files(self):
+        data = random.Random(26).randbytes(1024 * 1024)
+        with open("test_chunks1.bin", "wb") as f:
+            f.write(data)
+        with open("test_chunks2.bin", "wb") as f:
+            # Same content with a few bytes inserted in the middle
+            f.write(data[:500000] + b"inserted" + data[500000:])
+
+        chunked = ChunkedFileHash("./test_chunks1.bin")
+        chunks = list(chunked)
+        other_chunks = list(ChunkedFileHash("./test_chunks2.bin"))
+
+        self.assertEqual(chunked.hexdigest(), get_file_hash("./test_chunks1.bin"))
+        self.assertEqual(sum(chunk[1] for chunk in chunks), len(data))
+        common = Counter((size, digest) for _, size, digest in chunks) & Counter((size, digest) for _, size, digest in other_chunks)
+        expected_shared = sum(size * count for (size, _), count in common.items())
+        self.assertGreater(expected_shared, len(data) - 2 * CDC_MAX_SIZE)
+
+        db = DBManager("test_db_chunks.db")
+        db.insert_file("/test/chunks1.bin", "chunks1.bin", len(data), time.time(), time.time(), None, ChunkedFileHash("./test_chunks1.bin"))
+        db.insert_file("/test/chunks2.bin", "chunks2.bin", len(data) + 8, time.time(), time.time(), None, ChunkedFileHash("./test_chunks2.bin"))
+        db.insert_file("/test/copy.bin", "copy.bin", len(data), time.time(), time.time(), chunked.hexdigest(), chunks)
+
+        self.assertEqual(db.get_file_by_hash(chunked.hexdigest())[0]['path'], "/test/chunks1.bin")
+        shared = db.get_shared_chunks(min_shared_bytes=0)
+        # The identical copy is reported by get_duplicates, not as a shared chunks pair
+        self.assertEqual(len(shared), 2)
+        for pair in shared:
+            self.assertIn("/test/chunks2.bin", (pair['path_a'], pair['path_b']))
+            self.assertEqual(pair['shared_bytes'], expected_shared)
+            self.assertEqual(pair['shared_unique_bytes'], expected_shared)
+
+        db.set_file_inactive("/test/copy.bin")
+        self.assertEqual(len(db.get_shared_chunks(min_shared_bytes=0)), 1)
+        self.assertEqual(db.get_shared_chunks(min_shared_bytes=expected_shared + 1), [])
+
+        if os.path.exists("test_db_chunks.db"):
+            db.close()
+            os.remove("test_db_chunks.db")
+
+        if os.path.exists("./test_chunks1.bin"):
+            os.remove("./test_chunks1.bin")
+
+        if os.path.exists("./test_chunks2.bin"):
+            os.remove("./test_chunks2.bin")
+
+    @unittest.skipUnless(chunking_available(), "pyfastcdc is not installed")
+    def test_chunk_sizes(self):
+        with open("test_chunks_empty.bin", "wb") as f:
+            pass
+        with open("test_chunks_short.bin", "wb") as f:
+            f.write(random.Random(1).randbytes(CDC_MIN_SIZE - 1))
+        with open("test_chunks_long.bin", "wb") as f:
+            f.write(random.Random(2).randbytes(4 * 1024 * 1024))
+
+        # The full-file hash isn't known before the chunks are read
+        chunked = ChunkedFileHash("./test_chunks_empty.bin")
+        with self.assertRaises(RuntimeError):
+            chunked.hexdigest()
+        self.assertEqual(list(chunked), [])
+        self.assertEqual(chunked.hexdigest(), get_file_hash("./test_chunks_empty.bin"))
+
+        # Reading the chunks again gives the same file hash
+        chunked = ChunkedFileHash("./test_chunks_long.bin")
+        first_pass = list(chunked)
+        self.assertEqual(list(chunked), first_pass)
+        self.assertEqual(chunked.hexdigest(), get_file_hash("./test_chunks_long.bin"))
+
+        short_chunks = list(ChunkedFileHash("./test_chunks_short.bin"))
+        self.assertEqual(len(short_chunks), 1)
+        self.assertEqual(short_chunks[0][:2], (0, CDC_MIN_SIZE - 1))
+        self.assertEqual(len(short_chunks[0][2]), 16)
+
+        long_chunks = list(ChunkedFileHash("./test_chunks_long.bin"))
+        sizes = [chunk[1] for chunk in long_chunks[:-1]]
+        self.assertTrue(all(CDC_MIN_SIZE <= size <= CDC_MAX_SIZE for size in sizes))
+        # Cuts are found with both the strict mask before the average size and the loose mask after it
+        self.assertTrue(any(size <= CDC_AVG_SIZE for size in sizes))
+        self.assertTrue(any(size > CDC_AVG_SIZE for size in sizes))
+        self.assertEqual([chunk[0] for chunk in long_chunks], [0] + [sum(sizes[:i + 1]) for i in range(len(sizes))])
+
+        for test_file in ("./test_chunks_empty.bin", "./test_chunks_short.bin", "./test_chunks_long.bin"):
+            if os.path.exists(test_file):
+                os.remove(test_file)
+
+    def test_shared_chunks_counts_repeated_chunks(self):
+        db = DBManager("test_db_shared_chunks.db")
+        zero_block = (b"\x00" * 16, 100)
+        db.insert_file("/test/image1.img", "image1.img", 450, time.time(), time.time(), "hash1",
+                       [(i * 100, 100, zero_block[0]) for i in range(4)] + [(400, 50, b"a" * 16)])
+        db.insert_file("/test/image2.img", "image2.img", 250, time.time(), time.time(), "hash2",
+                       [(i * 100, 100, zero_block[0]) for i in range(2)] + [(200, 50, b"b" * 16)])
+
+        shared = db.get_shared_chunks(min_shared_bytes=0)
+        self.assertEqual(len(shared), 1)
+        self.assertEqual(shared[0]['shared_bytes'], 200)
+        self.assertEqual(shared[0]['shared_unique_bytes'], 100)
+
+        # A stale hash row left by rehashing must not multiply the shared bytes
+        db.cursor.execute("INSERT INTO hashes (hash_value, file_id) SELECT 'old_hash1', id FROM files WHERE path = ?", ("/test/image1.img",))
+        db.conn.commit()
+        shared = db.get_shared_chunks(min_shared_bytes=0)
+        self.assertEqual(len(shared), 1)
+        self.assertEqual(shared[0]['shared_bytes'], 200)
+
+        if os.path.exists("test_db_shared_chunks.db"):
+            db.close()
+            os.remove("test_db_shared_chunks.db")
+
+    def test_shared_chunks_ignores_common_chunks(self):
+        db = DBManager("test_db_common_chunks.db")
+        # Every image holds the same zero-filled block next to its own data
+        for i in range(5):
+            db.insert_file(f"/test/vm{i}.img", f"vm{i}.img", 300, time.time(), time.time(), f"vm_hash{i}",
+                           [(0, 100, b"\x00" * 16), (100, 200, bytes([i + 1]) * 16)])
+        # Two of them also share a larger block
+        db.set_file_chunks("/test/vm0.img", [(0, 100, b"\x00" * 16), (100, 200, b"s" * 16)])
+        db.set_file_chunks("/test/vm1.img", [(0, 100, b"\x00" * 16), (100, 200, b"s" * 16)])
+
+        self.assertEqual(len(db.get_shared_chunks(min_shared_bytes=0, max_chunk_files=5)), 10)
+        shared = db.get_shared_chunks(min_shared_bytes=0, max_chunk_files=4)
+        self.assertEqual([(pair['path_a'], pair['path_b'], pair['shared_bytes']) for pair in shared], [("/test/vm0.img", "/test/vm1.img", 200)])
+        self.assertEqual(db.get_shared_chunks(min_shared_bytes=201, max_chunk_files=4), [])
+
+        if os.path.exists("test_db_common_chunks.db"):
+            db.close()
+            os.remove("test_db_common_chunks.db")
+
+    def test_set_file_chunks(self):
+        db = DBManager("test_db_set_chunks.db")
+        db.insert_file("/test/known.img", "known.img", 100, time.time(), time.time(), "known_hash")
+
+        self.assertFalse(db.has_chunks("/test/known.img"))
+        self.assertTrue(db.set_file_chunks("/test/known.img", [(0, 100, b"c" * 16)]))
+        self.assertTrue(db.has_chunks("/test/known.img"))
+        self.assertFalse(db.set_file_chunks("/test/unknown.img", [(0, 100, b"c" * 16)]))
+        self.assertFalse(db.has_chunks("/test/unknown.img"))
+
+        if os.path.exists("test_db_set_chunks.db"):
+            db.close()
+            os.remove("test_db_set_chunks.db")
+
+    def test_chunks_table_added_to_existing_db(self):
+        # Database as created before chunking was added
+        conn = sqlite3.connect("test_db_old.db")
+        conn.execute("CREATE TABLE files (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, path TEXT UNIQUE NOT NULL, size INTEGER NOT NULL, last_modified INTEGER NOT NULL, last_scan INTEGER NOT NULL, active BOOLEAN NOT NULL DEFAULT TRUE, deactivated_at INTEGER DEFAULT NULL)")
+        conn.execute("CREATE TABLE hashes (hash_value TEXT NOT NULL, file_id INTEGER NOT NULL, PRIMARY KEY (hash_value, file_id), FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE)")
+        conn.commit()
+        conn.close()
+
+        db = DBManager("test_db_old.db")
+        db.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'idx_chunk_hash'")
+        self.assertIsNotNone(db.cursor.fetchone())
+        self.assertTrue(db.insert_file("/test/old.img", "old.img", 100, time.time(), time.time(), "old_hash", [(0, 100, b"d" * 16)]))
+        self.assertTrue(db.has_chunks("/test/old.img"))
+
+        if os.path.exists("test_db_old.db"):
+            db.close()
+            os.remove("test_db_old.db")
+
+    def test_swapped_paths_fixed_in_existing_db(self):
+        # Earlier versions stored the full path in file_name and the base name in path
+        conn = sqlite3.connect("test_db_swapped.db")
+        conn.execute("CREATE TABLE files (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, path TEXT UNIQUE NOT NULL, size INTEGER NOT NULL, last_modified INTEGER NOT NULL, last_scan INTEGER NOT NULL, active BOOLEAN NOT NULL DEFAULT TRUE, deactivated_at INTEGER DEFAULT NULL)")
+        conn.execute("CREATE TABLE hashes (hash_value TEXT NOT NULL, file_id INTEGER NOT NULL, PRIMARY KEY (hash_value, file_id), FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE)")
+        for file_id, name in enumerate(("one.txt", "two.txt", "three.txt"), 1):
+            conn.execute("INSERT INTO files (id, file_name, path, size, last_modified, last_scan) VALUES (?, ?, ?, 10, 0, 0)", (file_id, os.path.join("/test", name), name))
+            conn.execute("INSERT INTO hashes (hash_value, file_id) VALUES (?, ?)", (f"swapped_hash{file_id}", file_id))
+        # three.txt was already stored again the right way round
+        conn.execute("INSERT INTO files (id, file_name, path, size, last_modified, last_scan) VALUES (4, 'three.txt', ?, 10, 0, 0)", (os.path.join("/test", "three.txt"),))
+        conn.execute("INSERT INTO hashes (hash_value, file_id) VALUES ('swapped_hash3', 4)")
+        conn.commit()
+        conn.close()
+
+        db = DBManager("test_db_swapped.db")
+        for name in ("one.txt", "two.txt", "three.txt"):
+            file = db.get_file_by_path(os.path.join("/test", name))
+            self.assertIsNotNone(file)
+            self.assertEqual(file['file_name'], name)
+            self.assertTrue(db.lookup_file(file_path=os.path.join("/test", name)))
+        self.assertEqual(len(db.get_active_files()), 3)
+        self.assertEqual(db.get_duplicates(), {})
+
+        if os.path.exists("test_db_swapped.db"):
+            db.close()
+            os.remove("test_db_swapped.db")
+
+    def test_removing_files_removes_chunks(self):
+        with open("test_chunks_present.bin", "wb") as f:
+            f.write(b"present")
+        present_path = os.path.abspath("test_chunks_present.bin")
+
+        db = DBManager("test_db_remove_chunks.db")
+        db.insert_file(present_path, "test_chunks_present.bin", 7, time.time(), time.time(), "present_hash", [(0, 7, b"e" * 16)])
+        db.insert_file("/test/missing.img", "missing.img", 100, time.time(), time.time(), "missing_hash", [(0, 100, b"f" * 16)])
+        db.insert_file("/test/removed.img", "removed.img", 100, time.time(), time.time(), "removed_hash", [(0, 100, b"g" * 16)])
+
+        self.assertTrue(db.remove_file("/test/removed.img"))
+        self.assertEqual(db.clean_missing_files(), 1)
+
+        db.cursor.execute("SELECT chunk_hash FROM chunks")
+        self.assertEqual([row[0] for row in db.cursor.fetchall()], [b"e" * 16])
+
+        if os.path.exists("test_db_remove_chunks.db"):
+            db.close()
+            os.remove("test_db_remove_chunks.db")
+
+        if os.path.exists("test_chunks_present.bin"):
+            os.remove("test_chunks_present.bin")
+
   
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file